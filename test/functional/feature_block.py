@@ -61,15 +61,14 @@ class CBrokenBlock(CBlock):
         self.hashImMerkleRoot = self.calc_immutable_merkle_root()
 
     def serialize(self, **kwargs):
-        r = b""
-        r += super(CBlock, self).serialize()
-        r += struct.pack("<BQ", 255, len(self.vtx))
+        r = [super(CBlock, self).serialize()]
+        r.append(struct.pack("<BQ", 255, len(self.vtx)))
         for tx in self.vtx:
             if(kwargs.get('with_witness') == True):
-                r += tx.serialize_with_witness(**kwargs)
+                r.append(tx.serialize_with_witness(**kwargs))
             else:
-                r += tx.serialize_without_witness(**kwargs)
-        return r
+                r.append(tx.serialize_without_witness(**kwargs))
+        return b"".join(r)
 
     def normal_serialize(self):
         return super().serialize()
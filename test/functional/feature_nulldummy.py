@@ -7,33 +7,33 @@
 
 Connect to a single node.
 Generate 2 blocks (save the coinbases for later).
-Generate 427 more blocks.
-[Policy/Consensus] Check that NULLDUMMY compliant transactions are accepted in the 430th block.
-[Policy] Check that non-NULLDUMMY transactions are rejected before activation.
-[Consensus] Check that the new NULLDUMMY rules are not enforced on the 431st block.
-[Policy/Consensus] Check that the new NULLDUMMY rules are enforced on the 432nd block.
+Generate 100 more blocks so the first coinbase matures.
+[Policy/Consensus] Check that NULLDUMMY compliant transactions are accepted in the 103rd block.
+[Policy] Check that non-NULLDUMMY transactions are rejected from the mempool.
+[Consensus] Check that non-NULLDUMMY transactions are rejected in a block.
+[Policy/Consensus] Check that NULLDUMMY compliant transactions are accepted in the 104th block.
 """
 
-from test_framework.blocktools import create_coinbase, create_block, create_transaction, add_witness_commitment
-from test_framework.messages import CTransaction, CTxInWitness
-from test_framework.script import CScript
+from test_framework.blocktools import create_coinbase, create_block, create_transaction_to_script, add_witness_commitment
+from test_framework.messages import CTxInWitness
+from test_framework.script import CScript, OP_0
 from test_framework.test_framework import BitcoinTestFramework
-from test_framework.util import assert_equal, assert_raises_rpc_error, bytes_to_hex_str
+from test_framework.util import assert_equal, assert_raises_rpc_error, batch_results, hex_str_to_bytes
 
-import time
+import copy
 
 NULLDUMMY_ERROR = "mandatory-script-verify-flag-failed (Dummy CHECKMULTISIG argument must be zero) (code 16)"
+# submitblock's reason for rejecting a block with a non-NULLDUMMY transaction.
+# With script check threads the block only fails as a whole, so the reason
+# is the generic one.
+NULLDUMMY_BLOCK_ERRORS = ["mandatory-script-verify-flag-failed (Dummy CHECKMULTISIG argument must be zero)", "block-validation-failed"]
 
 def trueDummy(tx):
-    scriptSig = CScript(tx.vin[0].scriptSig)
-    newscript = []
-    for i in scriptSig:
-        if (len(newscript) == 0):
-            assert(len(i) == 0)
-            newscript.append(b'\x51')
-        else:
-            newscript.append(i)
-    tx.vin[0].scriptSig = CScript(newscript)
+    # Replace the leading empty push (the CHECKMULTISIG dummy) with a
+    # one-byte push of 0x51, patching the raw bytes instead of re-parsing.
+    scriptSig = bytes(tx.vin[0].scriptSig)
+    assert_equal(scriptSig[0], OP_0)
+    tx.vin[0].scriptSig = CScript(b'\x01\x51' + scriptSig[1:])
     tx.rehash()
 
 class NULLDUMMYTest(BitcoinTestFramework):
@@ -43,65 +43,73 @@ class NULLDUMMYTest(BitcoinTestFramework):
         self.setup_clean_chain = True
         # This script tests NULLDUMMY activation, using default segwit activation(ALWAYS_ON)
         self.extra_args = [['-whitelist=127.0.0.1', '-addresstype=legacy', "-deprecatedrpc=addwitnessaddress"]]
-        self.mocktime = int(time.time())
 
     def run_test(self):
         self.address = self.nodes[0].getnewaddress()
         self.ms_address = self.nodes[0].addmultisigaddress(1,[self.address])['address']
+        # Cache the output scripts so transactions can be built without createrawtransaction
+        self.scripts = {a: hex_str_to_bytes(self.nodes[0].getaddressinfo(a)['scriptPubKey']) for a in (self.address, self.ms_address)}
 
         self.coinbase_blocks = self.nodes[0].generate(2, self.signblockprivkeys) # Block 2
-        coinbase_txid = []
-        for i in self.coinbase_blocks:
-            coinbase_txid.append(self.nodes[0].getblock(i)['tx'][0])
-        self.nodes[0].generate(427, self.signblockprivkeys) # Block 429
-        self.lastblockhash = self.nodes[0].getbestblockhash()
+        # Fetch both coinbase blocks in a single JSON-RPC batch request
+        blocks = batch_results(self.nodes[0], [self.nodes[0].getblock.get_request(i) for i in self.coinbase_blocks])
+        coinbase_txid = [b['tx'][0] for b in blocks]
+        # NULLDUMMY has no activation height here, so only coinbase maturity
+        # (100 blocks) is needed before the first coinbase can be spent.
+        self.lastblockhash = self.nodes[0].generate(100, self.signblockprivkeys)[-1] # Block 102
         self.tip = int("0x" + self.lastblockhash, 0)
-        self.lastblockheight = 429
-        self.lastblocktime = int(time.time()) + 429
+        self.lastblockheight = 102
+        self.lastblocktime = self.nodes[0].getblockheader(self.lastblockhash)['time']
 
         self.log.info("Test 1: NULLDUMMY compliant base transactions should be accepted to mempool")
-        test1txs = [create_transaction(self.nodes[0], coinbase_txid[0], self.ms_address, amount=49)]
-        txid1 = self.nodes[0].sendrawtransaction(bytes_to_hex_str(test1txs[0].serialize_with_witness()), True)
-        test1txs.append(create_transaction(self.nodes[0], txid1, self.ms_address, amount=48))
-        txid2 = self.nodes[0].sendrawtransaction(bytes_to_hex_str(test1txs[1].serialize_with_witness()), True)
+        test1txs = [create_transaction_to_script(self.nodes[0], coinbase_txid[0], self.scripts[self.ms_address], amount=49)]
+        txid1 = self.nodes[0].sendrawtransaction(test1txs[0].serialize_with_witness().hex(), True)
+        test1txs.append(create_transaction_to_script(self.nodes[0], txid1, self.scripts[self.ms_address], amount=48))
+        txid2 = self.nodes[0].sendrawtransaction(test1txs[1].serialize_with_witness().hex(), True)
         self.block_submit(self.nodes[0], test1txs, False, True)
 
         self.log.info("Test 2: Non-NULLDUMMY base multisig transaction should not be accepted to mempool")
-        test2tx = create_transaction(self.nodes[0], txid2, self.ms_address, amount=47.99999)
+        test2tx = create_transaction_to_script(self.nodes[0], txid2, self.scripts[self.ms_address], amount=47.99999)
         trueDummy(test2tx)
-        assert_raises_rpc_error(-26, NULLDUMMY_ERROR, self.nodes[0].sendrawtransaction, bytes_to_hex_str(test2tx.serialize_with_witness()), True)
+        assert_raises_rpc_error(-26, NULLDUMMY_ERROR, self.nodes[0].sendrawtransaction, test2tx.serialize_with_witness().hex(), True)
 
         self.log.info("Test 3: Non-NULLDUMMY base transactions should not be accepted in a block")
         self.block_submit(self.nodes[0], [test2tx], False)
 
         self.log.info("Test 4: Non-NULLDUMMY base multisig transaction is invalid ")
-        test4tx = create_transaction(self.nodes[0], txid2, self.address, amount=46)
-        test6txs=[CTransaction(test4tx)]
+        test4tx = create_transaction_to_script(self.nodes[0], txid2, self.scripts[self.address], amount=46)
+        # trueDummy only rebinds vin[0].scriptSig, so a shallow copy with its own
+        # vin[0] keeps the compliant transaction without a full deep copy.
+        test6txs = [copy.copy(test4tx)]
+        test6txs[0].vin = [copy.copy(test4tx.vin[0])] + test4tx.vin[1:]
         trueDummy(test4tx)
-        assert_raises_rpc_error(-26, NULLDUMMY_ERROR, self.nodes[0].sendrawtransaction, bytes_to_hex_str(test4tx.serialize_with_witness()), True)
+        assert_raises_rpc_error(-26, NULLDUMMY_ERROR, self.nodes[0].sendrawtransaction, test4tx.serialize_with_witness().hex(), True)
         self.block_submit(self.nodes[0], [test4tx])
 
         self.log.info("Test 6: NULLDUMMY compliant base transactions should be accepted to mempool and in block")
-        for i in test6txs:
-            self.nodes[0].sendrawtransaction(bytes_to_hex_str(i.serialize()), True)
+        batch_results(self.nodes[0], [self.nodes[0].sendrawtransaction.get_request(i.serialize().hex(), True) for i in test6txs])
         self.block_submit(self.nodes[0], test6txs, False, True)
 
 
     def block_submit(self, node, txs, witness = False, accept = False):
-        block = create_block(self.tip, create_coinbase(self.lastblockheight + 1), self.lastblocktime + 1)
-        for tx in txs:
-            tx.rehash()
-            block.vtx.append(tx)
-        block.hashMerkleRoot = block.calc_merkle_root()
-        block.hashImMerkleRoot = block.calc_immutable_merkle_root()
+        block = create_block(self.tip, create_coinbase(self.lastblockheight + 1), self.lastblocktime + 1, txs)
         witness and add_witness_commitment(block)
         block.rehash()
         block.solve(self.signblockprivkeys)
-        blockbytes = block.serialize(with_witness=True)
         if(witness):
-            assert_raises_rpc_error(-22, "Block does not start with a coinbase", node.submitblock, bytes_to_hex_str(blockbytes))
+            # The witness marker is what makes this block undecodable, so
+            # only this branch needs the witness serialization.
+            blockbytes = block.serialize(with_witness=True)
+            assert_raises_rpc_error(-22, "Block does not start with a coinbase", node.submitblock, blockbytes.hex())
         else:
-            node.submitblock(bytes_to_hex_str(blockbytes))
+            # None of the transactions carry witnesses. submitblock returns
+            # None if the block was accepted and the rejection reason
+            # otherwise.
+            result = node.submitblock(block.serialize().hex())
+            if (accept):
+                assert_equal(result, None)
+            else:
+                assert result in NULLDUMMY_BLOCK_ERRORS, result
         if (accept):
             assert_equal(node.getbestblockhash(), block.hash)
             self.tip = block.sha256
@@ -35,10 +35,11 @@ from test_framework.messages import (
     msg_witness_tx,
     ser_uint256,
     ser_vector,
+    hash256,
     sha256,
     uint256_from_str,
-    ser_string_vector,
-    ser_compact_size
+    ser_string_vector_len,
+    ser_compact_size_len
 )
 from test_framework.mininode import (
     P2PInterface,
@@ -77,11 +78,11 @@ from test_framework.script import (
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import (
     assert_equal,
+    batch_results,
     bytes_to_hex_str,
     connect_nodes,
     disconnect_nodes,
     get_bip9_status,
-    hex_str_to_bytes,
     sync_blocks,
     sync_mempools,
     assert_raises_rpc_error
@@ -94,6 +95,9 @@ VB_TOP_BITS = 0x20000000
 
 MAX_SIGOP_COST = 80000
 
+# Anyone-can-spend output script; CScript is immutable, so one instance is shared
+ANYONE_CAN_SPEND_SCRIPT = CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE])
+
 class UTXO():
     """Used to keep track of anyone-can-spend outputs that we can use in the tests."""
     def __init__(self, sha256, n, value):
@@ -105,22 +109,48 @@ def get_p2pkh_script(pubkeyhash):
     """Get the script associated with a P2PKH."""
     return CScript([CScriptOp(OP_DUP), CScriptOp(OP_HASH160), pubkeyhash, CScriptOp(OP_EQUALVERIFY), CScriptOp(OP_CHECKSIG)])
 
-def sign_p2pk_witness_input(script, tx_to, in_idx, hashtype, value, key):
-    """Add signature for a P2PK witness program."""
-    tx_hash = SegwitVersion1SignatureHash(script, tx_to, in_idx, hashtype, value)
-    signature = key.sign(tx_hash) + chr(hashtype).encode('latin-1')
+def get_p2wsh_script(witness_hash):
+    """Get the P2WSH script (OP_0 followed by a 32-byte push) for a witness script hash."""
+    assert_equal(len(witness_hash), 32)
+    return CScript(b'\x00\x20' + witness_hash)
+
+# Witness programs (and their P2WSH scripts) shared by many subtests
+WITNESS_PROGRAM_OP_TRUE = CScript([OP_TRUE])
+WITNESS_HASH_OP_TRUE = sha256(WITNESS_PROGRAM_OP_TRUE)
+P2WSH_OP_TRUE = get_p2wsh_script(WITNESS_HASH_OP_TRUE)
+WITNESS_PROGRAM_DROP_TRUE = CScript([OP_DROP, OP_TRUE])
+WITNESS_HASH_DROP_TRUE = sha256(WITNESS_PROGRAM_DROP_TRUE)
+P2WSH_DROP_TRUE = get_p2wsh_script(WITNESS_HASH_DROP_TRUE)
+
+# Serialized small integers used as witness reserved values / fake commitments
+SER_UINT256_ZERO = ser_uint256(0)
+SER_UINT256_ONE = ser_uint256(1)
+SER_UINT256_TWO = ser_uint256(2)
+
+def sign_p2pk_witness_input(script, tx_to, in_idx, hashtype, value, key, sighash_cache=None, rehash=True):
+    """Add signature for a P2PK witness program.
+
+    Pass the same sighash_cache dict when signing several inputs of tx_to.
+    The witness isn't part of the txid, so a caller that signs several inputs
+    in a row can pass rehash=False and rehash tx_to once at the end."""
+    tx_hash = SegwitVersion1SignatureHash(script, tx_to, in_idx, hashtype, value, sighash_cache)
+    signature = key.sign(tx_hash) + bytes([hashtype])
     tx_to.wit.vtxinwit[in_idx].scriptWitness.stack = [signature, script]
-    tx_to.rehash()
+    if rehash:
+        tx_to.rehash()
 
 def get_virtual_size(witness_block):
     """Calculate the virtual size of a witness block.
 
     Virtual size is base + witness/4."""
-    base_size = len(witness_block.serialize(with_witness=False))
-    total_size = len(witness_block.serialize(with_witness=True))
+    base_size = witness_block.serialized_size(with_witness=False)
+    total_size = witness_block.serialized_size(with_witness=True)
+    return virtual_size_from_sizes(base_size, total_size)
+
+def virtual_size_from_sizes(base_size, total_size):
+    """Virtual size for the given serialized sizes without and with witness."""
     # the "+3" is so we round up
-    vsize = int((3 * base_size + total_size + 3) / 4)
-    return vsize
+    return (3 * base_size + total_size + 3) // 4
 
 def test_transaction_acceptance(rpc, p2p, tx, with_witness, accepted, reason=None):
     """Send a transaction to the node and check that it's accepted to the mempool
@@ -138,6 +168,36 @@ def test_transaction_acceptance(rpc, p2p, tx, with_witness, accepted, reason=Non
         with mininode_lock:
             assert_equal(p2p.last_message["reject"].reason, reason)
 
+def test_transactions_acceptance(rpc, p2p, txs, with_witness, accepted):
+    """Send several transactions to the node and check that they're all accepted
+    to the mempool, or all rejected.
+
+    Same as test_transaction_acceptance, but the messages are pipelined behind
+    a single ping and the mempool is fetched once. The peer processes them in
+    order, so later transactions may spend earlier ones."""
+    for tx in txs:
+        p2p.send_message(msg_witness_tx(tx) if with_witness else msg_tx(tx))
+    p2p.sync_with_ping()
+    mempool = rpc.getrawmempool()
+    for tx in txs:
+        assert_equal(tx.hashMalFix in mempool, accepted)
+
+def test_transaction_rejection(rpc, p2p, tx, reason=None):
+    """Send a transaction with and then without its witness and check that the
+    node rejects both.
+
+    Same as test_transaction_acceptance with accepted=False for each encoding
+    in turn, but both messages are pipelined behind a single ping. The peer
+    processes them in order, so the last reject message belongs to the
+    witness-stripped transaction, which is what reason is checked against."""
+    p2p.send_message(msg_witness_tx(tx))
+    p2p.send_message(msg_tx(tx))
+    p2p.sync_with_ping()
+    assert_equal(tx.hashMalFix in rpc.getrawmempool(), False)
+    if reason is not None:
+        with mininode_lock:
+            assert_equal(p2p.last_message["reject"].reason, reason)
+
 def test_witness_block(rpc, p2p, block, with_witness, accepted, reason=None):
     """Send a block to the node and check that it's accepted
 
@@ -216,9 +276,12 @@ class SegWitTest(BitcoinTestFramework):
 
     def build_next_block(self, version=4):
         """Build a block on top of node0's tip."""
-        tip = self.nodes[0].getbestblockhash()
-        height = self.nodes[0].getblockcount() + 1
-        block_time = self.nodes[0].getblockheader(tip)["mediantime"] + 1
+        # getblockchaininfo reports the tip's hash, height and median time
+        # together, so one RPC replaces three and they can't disagree.
+        info = self.nodes[0].getblockchaininfo()
+        tip = info["bestblockhash"]
+        height = info["blocks"] + 1
+        block_time = info["mediantime"] + 1
         block = create_block(int(tip, 16), create_coinbase(height), block_time)
         block.version = version
         block.rehash()
@@ -230,8 +293,7 @@ class SegWitTest(BitcoinTestFramework):
         if with_witness:
             add_witness_commitment(block, nonce)
         else:
-            block.hashMerkleRoot = block.calc_merkle_root()
-            block.hashImMerkleRoot = block.calc_immutable_merkle_root()
+            block.hashMerkleRoot, block.hashImMerkleRoot = block.calc_merkle_roots()
         block.solve(self.signblockprivkeys)
 
     def run_test(self):
@@ -324,12 +386,14 @@ class SegWitTest(BitcoinTestFramework):
         # Create a transaction that spends the coinbase
         tx = CTransaction()
         tx.vin.append(CTxIn(COutPoint(txid, 0), b""))
-        tx.vout.append(CTxOut(49 * 100000000, CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE])))
+        tx.vout.append(CTxOut(49 * 100000000, ANYONE_CAN_SPEND_SCRIPT))
         tx.calc_sha256()
 
         # Check that serializing it with or without witness is the same
-        # This is a sanity check of our testing framework.
-        assert_equal(msg_tx(tx).serialize(), msg_witness_tx(tx).serialize())
+        # This is a sanity check of our testing framework. Comparing the
+        # witness serialization's hash with the txid computed above avoids
+        # building and holding the non-witness serialization as well.
+        assert_equal(uint256_from_str(hash256(msg_witness_tx(tx).serialize())), tx.sha256)
 
         self.test_node.send_message(msg_witness_tx(tx))
         self.test_node.sync_with_ping()  # make sure the tx was processed
@@ -413,17 +477,19 @@ class SegWitTest(BitcoinTestFramework):
         chain_height = self.nodes[0].getblockcount()
         # Pick 10 random blocks on main chain, and verify that getdata's
         # for MSG_BLOCK, MSG_WITNESS_BLOCK, and rpc getblock() are equal.
-        all_heights = list(range(chain_height + 1))
-        random.shuffle(all_heights)
-        all_heights = all_heights[0:10]
-        for height in all_heights:
-            block_hash = self.nodes[0].getblockhash(height)
-            rpc_block = self.nodes[0].getblock(block_hash, False)
+        all_heights = random.sample(range(chain_height + 1), min(10, chain_height + 1))
+        # Fetch the hashes and raw blocks with one batched RPC each. The p2p
+        # requests stay sequential since request_block() waits on the single
+        # last_message["block"] slot.
+        node = self.nodes[0]
+        block_hashes = batch_results(node, [node.getblockhash.get_request(height) for height in all_heights])
+        rpc_blocks = batch_results(node, [node.getblock.get_request(h, False) for h in block_hashes])
+        for block_hash, rpc_block in zip(block_hashes, rpc_blocks):
             block_hash = int(block_hash, 16)
             block = self.test_node.request_block(block_hash, 2)
             wit_block = self.test_node.request_block(block_hash, 2)
             assert_equal(block.serialize(with_witness=True), wit_block.serialize(with_witness=True))
-            assert_equal(block.serialize(), hex_str_to_bytes(rpc_block))
+            assert_equal(block.serialize().hex(), rpc_block)
 
 
     @subtest
@@ -444,9 +510,7 @@ class SegWitTest(BitcoinTestFramework):
         disconnect_nodes(self.nodes[0], 2)
 
         # Create two outputs, a p2wsh and p2sh-p2wsh
-        witness_program = CScript([OP_TRUE])
-        witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        script_pubkey = P2WSH_OP_TRUE
 
         p2sh_pubkey = hash160(script_pubkey)
         p2sh_script_pubkey = CScript([OP_HASH160, p2sh_pubkey, OP_EQUAL])
@@ -526,21 +590,20 @@ class SegWitTest(BitcoinTestFramework):
         txid = int(self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(), 1), 16)
         # Using mocktime lets us avoid sleep()
         sync_mempools(self.nodes)
-        self.nodes[0].setmocktime(int(time.time()) + 10)
-        self.nodes[2].setmocktime(int(time.time()) + 10)
+        mocktime = int(time.time()) + 10
 
         for node in [self.nodes[0], self.nodes[2]]:
-            gbt_results = node.getblocktemplate({"rules": ["segwit"]})
+            # Set mocktime, get the template and undo mocktime in one batched
+            # round trip; the node runs batched requests in order.
+            gbt_results = batch_results(node, [node.setmocktime.get_request(mocktime),
+                                               node.getblocktemplate.get_request({"rules": ["segwit"]}),
+                                               node.setmocktime.get_request(0)])[1]
             block_version = gbt_results['version']
             # If this is a non-segwit node, we should still not get a witness
             # commitment, nor a version bit signalling segwit.
             assert_equal(block_version & (1 << VB_WITNESS_BIT), 0)
             assert('default_witness_commitment' not in gbt_results)
 
-        # undo mocktime
-        self.nodes[0].setmocktime(0)
-        self.nodes[2].setmocktime(0)
-
     @subtest
     def test_witness_tx_relay_before_segwit_activation(self):
 
@@ -549,7 +612,7 @@ class SegWitTest(BitcoinTestFramework):
         # not be added to recently rejected list.
         tx = CTransaction()
         tx.vin.append(CTxIn(COutPoint(self.utxo[0].sha256, self.utxo[0].n), b""))
-        tx.vout.append(CTxOut(self.utxo[0].nValue - 1000, CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE])))
+        tx.vout.append(CTxOut(self.utxo[0].nValue - 1000, ANYONE_CAN_SPEND_SCRIPT))
         tx.wit.vtxinwit.append(CTxInWitness())
         tx.wit.vtxinwit[0].scriptWitness.stack = [b'a']
         tx.rehash()
@@ -567,8 +630,8 @@ class SegWitTest(BitcoinTestFramework):
         self.test_node.announce_tx_and_wait_for_getdata(tx, timeout=2, success=False)
 
         # Delivering this transaction without witness should succeed
-        assert_equal(len(self.nodes[0].getrawmempool()), 1)
-        assert_equal(len(self.nodes[1].getrawmempool()), 1)
+        assert_equal(self.nodes[0].getmempoolinfo()['size'], 1)
+        assert_equal(self.nodes[1].getmempoolinfo()['size'], 1)
 
         # sent without witness
         test_transaction_acceptance(self.nodes[0].rpc, self.old_node, tx, with_witness=True, accepted=False)
@@ -579,7 +642,7 @@ class SegWitTest(BitcoinTestFramework):
 
         # Cleanup: mine the first transaction and update utxo
         self.nodes[0].generate(1, self.signblockprivkeys)
-        assert_equal(len(self.nodes[0].getrawmempool()), 0)
+        assert_equal(self.nodes[0].getmempoolinfo()['size'], 0)
 
         self.utxo.pop(0)
         self.utxo.append(UTXO(tx_hash, 0, tx_value))
@@ -591,9 +654,9 @@ class SegWitTest(BitcoinTestFramework):
         V0 segwit outputs and inputs are always standard.
         V0 segwit inputs may only be mined after activation, but not before."""
 
-        witness_program = CScript([OP_TRUE])
-        witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        witness_program = WITNESS_PROGRAM_OP_TRUE
+        witness_hash = WITNESS_HASH_OP_TRUE
+        script_pubkey = P2WSH_OP_TRUE
 
         p2sh_pubkey = hash160(witness_program)
         p2sh_script_pubkey = CScript([OP_HASH160, p2sh_pubkey, OP_EQUAL])
@@ -643,7 +706,7 @@ class SegWitTest(BitcoinTestFramework):
         # P2PKH output; just send tx's first output back to an anyone-can-spend.
         #sync_mempools([self.nodes[0], self.nodes[1]])
         tx3.vin = [CTxIn(COutPoint(tx.malfixsha256, 0), b"")]
-        tx3.vout = [CTxOut(tx.vout[0].nValue - 1000, CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE]))]
+        tx3.vout = [CTxOut(tx.vout[0].nValue - 1000, ANYONE_CAN_SPEND_SCRIPT)]
         tx3.wit.vtxinwit.append(CTxInWitness())
         tx3.wit.vtxinwit[0].scriptWitness.stack = [witness_program]
         tx3.rehash()
@@ -663,7 +726,7 @@ class SegWitTest(BitcoinTestFramework):
         sync_blocks(self.nodes)
         self.utxo.pop(0)
         self.utxo.append(UTXO(tx3.malfixsha256, 0, tx3.vout[0].nValue))
-        assert_equal(len(self.nodes[1].getrawmempool()), 0)
+        assert_equal(self.nodes[1].getmempoolinfo()['size'], 0)
 
 
     @subtest
@@ -671,9 +734,7 @@ class SegWitTest(BitcoinTestFramework):
         """Test P2SH wrapped witness programs."""
 
         # Prepare the p2sh-wrapped witness output
-        witness_program = CScript([OP_DROP, OP_TRUE])
-        witness_hash = sha256(witness_program)
-        p2wsh_pubkey = CScript([OP_0, witness_hash])
+        p2wsh_pubkey = P2WSH_DROP_TRUE
         p2sh_witness_hash = hash160(p2wsh_pubkey)
         script_pubkey = CScript([OP_HASH160, p2sh_witness_hash, OP_EQUAL])
         script_sig = CScript([p2wsh_pubkey])  # a push of the redeem script
@@ -735,8 +796,6 @@ class SegWitTest(BitcoinTestFramework):
 
         #block without witness commitment
         block = self.build_next_block()
-        block.hashMerkleRoot = block.calc_merkle_root()
-        block.hashImMerkleRoot = block.calc_immutable_merkle_root()
         block.solve(self.signblockprivkeys)
 
         # Test the test -- witness serialization should be the same
@@ -758,8 +817,6 @@ class SegWitTest(BitcoinTestFramework):
 
         #same block without witness commitment
         block_2 = self.build_next_block()
-        block_2.hashMerkleRoot = block_2.calc_merkle_root()
-        block_2.hashImMerkleRoot = block_2.calc_immutable_merkle_root()
         block_2.solve(self.signblockprivkeys)
 
         # This should also be valid.
@@ -770,9 +827,8 @@ class SegWitTest(BitcoinTestFramework):
         tx.vin.append(CTxIn(COutPoint(self.utxo[0].sha256, self.utxo[0].n), b""))
 
         # Let's construct a witness program
-        witness_program = CScript([OP_TRUE])
-        witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        witness_program = WITNESS_PROGRAM_OP_TRUE
+        script_pubkey = P2WSH_OP_TRUE
         tx.vout.append(CTxOut(self.utxo[0].nValue - 1000, script_pubkey))
         tx.rehash()
 
@@ -789,10 +845,9 @@ class SegWitTest(BitcoinTestFramework):
         # Add an extra OP_RETURN output that matches the witness commitment template,
         # even though it has extra data after the incorrect commitment.
         # This block should fail.
-        block_3.vtx[0].vout.append(CTxOut(0, CScript([OP_RETURN, WITNESS_COMMITMENT_HEADER + ser_uint256(2), 10])))
+        block_3.vtx[0].vout.append(CTxOut(0, CScript([OP_RETURN, WITNESS_COMMITMENT_HEADER + SER_UINT256_TWO, 10])))
         block_3.vtx[0].rehash()
-        block_3.hashMerkleRoot = block_3.calc_merkle_root()
-        block_3.hashImMerkleRoot = block_3.calc_immutable_merkle_root()
+        block_3.hashMerkleRoot, block_3.hashImMerkleRoot = block_3.calc_merkle_roots()
         block_3.rehash()
         block_3.solve(self.signblockprivkeys)
 
@@ -800,8 +855,7 @@ class SegWitTest(BitcoinTestFramework):
 
         block_3 = self.build_next_block()
         block_3.vtx.extend([tx, tx2])
-        block_3.hashMerkleRoot = block_3.calc_merkle_root()
-        block_3.hashImMerkleRoot = block_3.calc_immutable_merkle_root()
+        block_3.hashMerkleRoot, block_3.hashImMerkleRoot = block_3.calc_merkle_roots()
         block_3.rehash()
         block_3.solve(self.signblockprivkeys)
 
@@ -823,8 +877,7 @@ class SegWitTest(BitcoinTestFramework):
         tx3.vout.append(CTxOut(tx.vout[0].nValue - 1000, witness_program))
         tx3.rehash()
         block_4.vtx.append(tx3)
-        block_4.hashMerkleRoot = block_4.calc_merkle_root()
-        block_4.hashImMerkleRoot = block_4.calc_immutable_merkle_root()
+        block_4.hashMerkleRoot, block_4.hashImMerkleRoot = block_4.calc_merkle_roots()
         block_4.solve(self.signblockprivkeys)
         block_4.rehash()
         test_witness_block(self.nodes[0].rpc, self.test_node, block_4, with_witness=True,accepted=True)
@@ -862,9 +915,7 @@ class SegWitTest(BitcoinTestFramework):
         block.solve(self.signblockprivkeys)
 
         # accepted without witness commitment
-        self.nodes[0].submitblock(bytes_to_hex_str(block.serialize()))
-
-        assert(self.nodes[0].getbestblockhash() == block.hash)
+        test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=False, accepted=True)
 
         # Now make sure that malleating the witness reserved value doesn't
         # result in a block permanently marked bad.
@@ -875,11 +926,11 @@ class SegWitTest(BitcoinTestFramework):
 
         # Change the nonce -- should not cause the block to be permanently
         # failed
-        block.vtx[0].wit.vtxinwit[0].scriptWitness.stack = [ser_uint256(1)]
+        block.vtx[0].wit.vtxinwit[0].scriptWitness.stack = [SER_UINT256_ONE]
         test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=True, accepted=False)
 
         # Changing the witness reserved value doesn't change the block hash
-        block.vtx[0].wit.vtxinwit[0].scriptWitness.stack = [ser_uint256(0)]
+        block.vtx[0].wit.vtxinwit[0].scriptWitness.stack = [SER_UINT256_ZERO]
         test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=True, accepted=False)
         test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=False, accepted=True)
 
@@ -923,32 +974,41 @@ class SegWitTest(BitcoinTestFramework):
         parent_tx.rehash()
 
         child_tx = CTransaction()
-        for i in range(NUM_OUTPUTS):
-            child_tx.vin.append(CTxIn(COutPoint(parent_tx.malfixsha256, i), b""))
+        child_tx.vin = [CTxIn(COutPoint(parent_tx.malfixsha256, i), b"") for i in range(NUM_OUTPUTS)]
         child_tx.vout = [CTxOut(value - 100000, CScript([OP_TRUE]))]
-        for i in range(NUM_OUTPUTS):
-            child_tx.wit.vtxinwit.append(CTxInWitness())
-            child_tx.wit.vtxinwit[-1].scriptWitness.stack = [b'a' * 195] * (2 * NUM_DROPS) + [witness_program]
+        # Every input gets its own copy of the stack, since the padding
+        # items are resized one by one below.
+        stack_template = [b'a' * 195] * (2 * NUM_DROPS) + [witness_program]
+        child_tx.wit.vtxinwit = [CTxInWitness() for i in range(NUM_OUTPUTS)]
+        for wit in child_tx.wit.vtxinwit:
+            wit.scriptWitness.stack = stack_template[:]
         child_tx.rehash()
         self.update_witness_block_with_transactions(block, [parent_tx, child_tx])
 
         block.solve(self.signblockprivkeys)
-        prooflen = len(ser_string_vector(block.proof)) - len(ser_compact_size(len(block.proof)))
+        prooflen = ser_string_vector_len(block.proof) - ser_compact_size_len(len(block.proof))
         vsize = get_virtual_size(block)
         additional_bytes = (MAX_BLOCK_BASE_SIZE - vsize) * 4
+        # Work out how much each padding item has to grow until we hit
+        # MAX_BLOCK_BASE_SIZE+1, then build every resized item exactly once.
+        target_sizes = {}
         i = 0
         while additional_bytes > 0:
-            # Add some more bytes to each input until we hit MAX_BLOCK_BASE_SIZE+1
             extra_bytes = min(additional_bytes + 1, 55)
-            block.vtx[-1].wit.vtxinwit[int(i / (2 * NUM_DROPS))].scriptWitness.stack[i % (2 * NUM_DROPS)] = b'a' * (195 + extra_bytes)
+            target_sizes[i] = 195 + extra_bytes
             additional_bytes -= extra_bytes
             i += 1
+        pads = {}
+        for i, size in target_sizes.items():
+            if size not in pads:
+                pads[size] = b'a' * size
+            block.vtx[-1].wit.vtxinwit[i // (2 * NUM_DROPS)].scriptWitness.stack[i % (2 * NUM_DROPS)] = pads[size]
 
         block.vtx[0].vout.pop()  # Remove old commitment
         add_witness_commitment(block)
         block.solve(self.signblockprivkeys)
         i = 0
-        while(prooflen != len(ser_string_vector(block.proof)) - len(ser_compact_size(len(block.proof))) and i < 10):
+        while(prooflen != ser_string_vector_len(block.proof) - ser_compact_size_len(len(block.proof)) and i < 10):
             block.solve(self.signblockprivkeys)
             i += 1
         vsize = get_virtual_size(block)
@@ -999,9 +1059,8 @@ class SegWitTest(BitcoinTestFramework):
 
         block = self.build_next_block()
 
-        witness_program = CScript([OP_DROP, OP_TRUE])
-        witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        witness_program = WITNESS_PROGRAM_DROP_TRUE
+        script_pubkey = P2WSH_DROP_TRUE
 
         # First try extra witness data on a tx that doesn't require a witness
         tx = CTransaction()
@@ -1071,10 +1130,6 @@ class SegWitTest(BitcoinTestFramework):
         #without witness commitment
         block = self.build_next_block()
         self.update_witness_block_with_transactions(block, [tx2], with_witness=False)
-        block.hashMerkleRoot = block.calc_merkle_root()
-        block.hashImMerkleRoot = block.calc_immutable_merkle_root()
-        block.rehash()
-        block.solve(self.signblockprivkeys)
         test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=False, accepted=True)
         # Update utxo for later tests
         self.utxo.pop(0)
@@ -1086,9 +1141,8 @@ class SegWitTest(BitcoinTestFramework):
 
         block = self.build_next_block()
 
-        witness_program = CScript([OP_DROP, OP_TRUE])
-        witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        witness_program = WITNESS_PROGRAM_DROP_TRUE
+        script_pubkey = P2WSH_DROP_TRUE
 
         tx = CTransaction()
         tx.vin.append(CTxIn(COutPoint(self.utxo[0].sha256, self.utxo[0].n), b""))
@@ -1118,10 +1172,13 @@ class SegWitTest(BitcoinTestFramework):
         MAX_PROGRAM_LENGTH = 10000
 
         # This program is 19 max pushes (9937 bytes), then 64 more opcode-bytes.
-        long_witness_program = CScript([b'a' * 520] * 19 + [OP_DROP] * 63 + [OP_TRUE])
+        # Both programs below share the pushes, so encode them only once.
+        # (Adding to a CScript would push its operand, hence the bytes join.)
+        max_pushes = CScript([b'a' * 520] * 19)
+        long_witness_program = CScript(b"".join([max_pushes, bytes([OP_DROP] * 63 + [OP_TRUE])]))
         assert(len(long_witness_program) == MAX_PROGRAM_LENGTH + 1)
         long_witness_hash = sha256(long_witness_program)
-        long_script_pubkey = CScript([OP_0, long_witness_hash])
+        long_script_pubkey = get_p2wsh_script(long_witness_hash)
 
         block = self.build_next_block()
 
@@ -1142,10 +1199,10 @@ class SegWitTest(BitcoinTestFramework):
         test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=True, accepted=False)
 
         # Try again with one less byte in the witness program
-        witness_program = CScript([b'a' * 520] * 19 + [OP_DROP] * 62 + [OP_TRUE])
+        witness_program = CScript(b"".join([max_pushes, bytes([OP_DROP] * 62 + [OP_TRUE])]))
         assert(len(witness_program) == MAX_PROGRAM_LENGTH)
         witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        script_pubkey = get_p2wsh_script(witness_hash)
 
         tx.vout[0] = CTxOut(tx.vout[0].nValue, script_pubkey)
         tx.rehash()
@@ -1164,9 +1221,8 @@ class SegWitTest(BitcoinTestFramework):
     def test_witness_input_length(self):
         """Test that vin length must match vtxinwit length."""
 
-        witness_program = CScript([OP_DROP, OP_TRUE])
-        witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        witness_program = WITNESS_PROGRAM_DROP_TRUE
+        script_pubkey = P2WSH_DROP_TRUE
 
         # Create a transaction that splits our utxo into many outputs
         tx = CTransaction()
@@ -1190,18 +1246,17 @@ class SegWitTest(BitcoinTestFramework):
                 flags = 0
                 if not self.wit.is_null():
                     flags |= 1
-                r = b""
-                r += struct.pack("<i", self.nVersion)
+                r = [struct.pack("<i", self.nVersion)]
                 if flags:
                     dummy = []
-                    r += ser_vector(dummy)
-                    r += struct.pack("<B", flags)
-                r += ser_vector(self.vin)
-                r += ser_vector(self.vout)
+                    r.append(ser_vector(dummy))
+                    r.append(struct.pack("<B", flags))
+                r.append(ser_vector(self.vin))
+                r.append(ser_vector(self.vout))
                 if flags & 1:
-                    r += self.wit.serialize()
-                r += struct.pack("<I", self.nLockTime)
-                return r
+                    r.append(self.wit.serialize())
+                r.append(struct.pack("<I", self.nLockTime))
+                return b"".join(r)
 
         tx2 = BrokenCTransaction()
         for i in range(10):
@@ -1235,7 +1290,7 @@ class SegWitTest(BitcoinTestFramework):
         # when spending a non-witness output.
         tx = CTransaction()
         tx.vin.append(CTxIn(COutPoint(self.utxo[0].sha256, self.utxo[0].n), b""))
-        tx.vout.append(CTxOut(self.utxo[0].nValue - 1000, CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE])))
+        tx.vout.append(CTxOut(self.utxo[0].nValue - 1000, ANYONE_CAN_SPEND_SCRIPT))
         tx.wit.vtxinwit.append(CTxInWitness())
         tx.wit.vtxinwit[0].scriptWitness.stack = [b'a']
         tx.rehash()
@@ -1244,16 +1299,15 @@ class SegWitTest(BitcoinTestFramework):
 
         # Verify that unnecessary witnesses are rejected.
         self.test_node.announce_tx_and_wait_for_getdata(tx)
-        assert_equal(len(self.nodes[0].getrawmempool()), 0)
+        assert_equal(self.nodes[0].getmempoolinfo()['size'], 0)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, tx, with_witness=True, accepted=False)
 
         # Verify that removing the witness succeeds.
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, tx, with_witness=False, accepted=True)
 
         # Now try to add extra witness data to a valid witness tx.
-        witness_program = CScript([OP_TRUE])
-        witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        witness_program = WITNESS_PROGRAM_OP_TRUE
+        script_pubkey = P2WSH_OP_TRUE
         tx2 = CTransaction()
         tx2.vin.append(CTxIn(COutPoint(tx_hash, 0), b""))
         tx2.vout.append(CTxOut(tx.vout[0].nValue - 1000, script_pubkey))
@@ -1278,7 +1332,7 @@ class SegWitTest(BitcoinTestFramework):
         test_transaction_acceptance(self.nodes[1].rpc, self.std_node, tx3, with_witness=False, accepted=False)
 
         # Remove witness stuffing, instead add extra witness push on stack
-        tx3.vout[0] = CTxOut(tx2.vout[0].nValue - 1000, CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE]))
+        tx3.vout[0] = CTxOut(tx2.vout[0].nValue - 1000, ANYONE_CAN_SPEND_SCRIPT)
         tx3.wit.vtxinwit[0].scriptWitness.stack = [CScript([CScriptNum(1)]), witness_program]
         tx3.rehash()
 
@@ -1292,7 +1346,7 @@ class SegWitTest(BitcoinTestFramework):
         # a witness transaction.
         self.old_node.wait_for_inv([CInv(1, tx2.malfixsha256)])  # wait until tx2 was inv'ed
         self.nodes[0].generate(1, self.signblockprivkeys)
-        assert_equal(len(self.nodes[0].getrawmempool()), 0)
+        assert_equal(self.nodes[0].getmempoolinfo()['size'], 0)
 
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, tx3, with_witness=True, accepted=False)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, tx3, with_witness=False, accepted=True)
@@ -1318,7 +1372,7 @@ class SegWitTest(BitcoinTestFramework):
 
         # Cleanup: mine the transactions and update utxo for next test
         self.nodes[0].generate(1, self.signblockprivkeys)
-        assert_equal(len(self.nodes[0].getrawmempool()), 0)
+        assert_equal(self.nodes[0].getmempoolinfo()['size'], 0)
 
         self.utxo.pop(0)
         self.utxo.append(UTXO(tx3.malfixsha256, 0, tx3.vout[0].nValue))
@@ -1349,9 +1403,9 @@ class SegWitTest(BitcoinTestFramework):
         sync_blocks(self.nodes)
         temp_utxo = []
         tx = CTransaction()
-        witness_program = CScript([OP_TRUE])
-        witness_hash = sha256(witness_program)
-        assert_equal(len(self.nodes[1].getrawmempool()), 0)
+        witness_program = WITNESS_PROGRAM_OP_TRUE
+        witness_hash = WITNESS_HASH_OP_TRUE
+        assert_equal(self.nodes[1].getmempoolinfo()['size'], 0)
         for version in list(range(OP_1, OP_16 + 1)) + [OP_0]:
             # First try to spend to a future version segwit script_pubkey.
             script_pubkey = CScript([CScriptOp(version), witness_hash])
@@ -1365,7 +1419,7 @@ class SegWitTest(BitcoinTestFramework):
 
         self.nodes[0].generate(1, self.signblockprivkeys)  # Mine all the transactions
         sync_blocks(self.nodes)
-        assert(len(self.nodes[0].getrawmempool()) == 0)
+        assert(self.nodes[0].getmempoolinfo()['size'] == 0)
 
         # Finally, verify that version 0 -> version 1 transactions
         # are non-standard
@@ -1422,9 +1476,8 @@ class SegWitTest(BitcoinTestFramework):
 
         block = self.build_next_block()
         # Change the output of the block to be a witness output.
-        witness_program = CScript([OP_TRUE])
-        witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        witness_program = WITNESS_PROGRAM_OP_TRUE
+        script_pubkey = P2WSH_OP_TRUE
         block.vtx[0].vout[0].scriptPubKey = script_pubkey
         # This next line will rehash the coinbase and update the merkle
         # root, and solve.
@@ -1490,7 +1543,7 @@ class SegWitTest(BitcoinTestFramework):
         # use in the next test.
         witness_program = CScript([pubkey, CScriptOp(OP_CHECKSIG)])
         witness_hash = sha256(witness_program)
-        script_wsh = CScript([OP_0, witness_hash])
+        script_wsh = get_p2wsh_script(witness_hash)
 
         tx2 = CTransaction()
         tx2.vin.append(CTxIn(COutPoint(tx.malfixsha256, 0), b""))
@@ -1589,7 +1642,7 @@ class SegWitTest(BitcoinTestFramework):
 
         witness_program = CScript([pubkey, CScriptOp(OP_CHECKSIG)])
         witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        script_pubkey = get_p2wsh_script(witness_hash)
 
         # First create a witness output for use in the tests.
         tx = CTransaction()
@@ -1654,6 +1707,10 @@ class SegWitTest(BitcoinTestFramework):
         test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=False, accepted=True)
 
         block = self.build_next_block()
+        # Keep the block's sizes up to date as transactions are appended,
+        # instead of walking the whole block after every append.
+        base_size = block.serialized_size(with_witness=False)
+        total_size = block.serialized_size(with_witness=True)
         used_sighash_single_out_of_bounds = False
         for i in range(NUM_SIGHASH_TESTS):
             # Ping regularly to keep the connection alive
@@ -1663,39 +1720,51 @@ class SegWitTest(BitcoinTestFramework):
             num_inputs = random.randint(1, 10)
             # Create a slight bias for producing more utxos
             num_outputs = random.randint(1, 11)
-            random.shuffle(temp_utxos)
             assert(len(temp_utxos) > num_inputs)
+            # Pick the inputs at random and swap-remove them from the pool,
+            # rather than shuffling the whole pool every iteration.
+            picks = sorted(random.sample(range(len(temp_utxos)), num_inputs), reverse=True)
+            spent_utxos = [temp_utxos[j] for j in picks]
+            for j in picks:
+                last = temp_utxos.pop()
+                if j < len(temp_utxos):
+                    temp_utxos[j] = last
             tx = CTransaction()
             total_value = 0
             for i in range(num_inputs):
-                tx.vin.append(CTxIn(COutPoint(temp_utxos[i].sha256, temp_utxos[i].n), b""))
+                tx.vin.append(CTxIn(COutPoint(spent_utxos[i].sha256, spent_utxos[i].n), b""))
                 tx.wit.vtxinwit.append(CTxInWitness())
-                total_value += temp_utxos[i].nValue
+                total_value += spent_utxos[i].nValue
             split_value = total_value // num_outputs
-            for i in range(num_outputs):
-                tx.vout.append(CTxOut(split_value, script_pubkey))
+            # The outputs are identical and never modified, so share one.
+            tx.vout = [CTxOut(split_value, script_pubkey)] * num_outputs
+            sighash_cache = {}
             for i in range(num_inputs):
                 # Now try to sign each input, using a random hashtype.
                 anyonecanpay = 0
                 if random.randint(0, 1):
                     anyonecanpay = SIGHASH_ANYONECANPAY
                 hashtype = random.randint(1, 3) | anyonecanpay
-                sign_p2pk_witness_input(witness_program, tx, i, hashtype, temp_utxos[i].nValue, key)
+                sign_p2pk_witness_input(witness_program, tx, i, hashtype, spent_utxos[i].nValue, key, sighash_cache, rehash=False)
                 if (hashtype == SIGHASH_SINGLE and i >= num_outputs):
                     used_sighash_single_out_of_bounds = True
             tx.rehash()
             for i in range(num_outputs):
                 temp_utxos.append(UTXO(tx.malfixsha256, i, split_value))
-            temp_utxos = temp_utxos[num_inputs:]
 
             block.vtx.append(tx)
+            vtx_len_delta = ser_compact_size_len(len(block.vtx)) - ser_compact_size_len(len(block.vtx) - 1)
+            base_size += tx.serialized_size() + vtx_len_delta
+            total_size += tx.serialized_size(with_witness=True) + vtx_len_delta
 
             # Test the block periodically, if we're close to maxblocksize
-            if (get_virtual_size(block) > MAX_BLOCK_BASE_SIZE - 1000):
+            if (virtual_size_from_sizes(base_size, total_size) > MAX_BLOCK_BASE_SIZE - 1000):
                 self.update_witness_block_with_transactions(block, [])
                 test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=True, accepted=False)
                 test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=False, accepted=True)
                 block = self.build_next_block()
+                base_size = block.serialized_size(with_witness=False)
+                total_size = block.serialized_size(with_witness=True)
 
         if (not used_sighash_single_out_of_bounds):
             self.log.info("WARNING: this test run didn't attempt SIGHASH_SINGLE with out-of-bounds index value")
@@ -1738,13 +1807,21 @@ class SegWitTest(BitcoinTestFramework):
         index = 0
         # Just spend to our usual anyone-can-spend output
         tx.vout = [CTxOut(output_value, CScript([OP_TRUE]))] * 2
+        # Use SIGHASH_ALL|SIGHASH_ANYONECANPAY so we can build up
+        # the signatures as we go.
+        hashtype = SIGHASH_ALL | SIGHASH_ANYONECANPAY
+        # An input is added before every signature, so the shared cache may
+        # only hold the outputs' hash. ANYONECANPAY never uses the prevouts
+        # and sequence entries, which depend on tx.vin.
+        assert(hashtype & SIGHASH_ANYONECANPAY)
+        sighash_cache = {}
         for i in temp_utxos:
-            # Use SIGHASH_ALL|SIGHASH_ANYONECANPAY so we can build up
-            # the signatures as we go.
             tx.vin.append(CTxIn(COutPoint(i.sha256, i.n), b""))
             tx.wit.vtxinwit.append(CTxInWitness())
-            sign_p2pk_witness_input(witness_program, tx, index, SIGHASH_ALL | SIGHASH_ANYONECANPAY, i.nValue, key)
+            sign_p2pk_witness_input(witness_program, tx, index, hashtype, i.nValue, key, sighash_cache, rehash=False)
             index += 1
+        assert_equal(list(sighash_cache), ['outputs'])
+        tx.rehash()
         block = self.build_next_block()
         self.update_witness_block_with_transactions(block, [tx])
         test_witness_block(self.nodes[0].rpc, self.test_node, block, with_witness=True, accepted=False)
@@ -1795,11 +1872,9 @@ class SegWitTest(BitcoinTestFramework):
         # Now create a new anyone-can-spend utxo for the next test.
         tx3 = CTransaction()
         tx3.vin.append(CTxIn(COutPoint(tx2.malfixsha256, 0), CScript([p2sh_program])))
-        tx3.vout.append(CTxOut(tx2.vout[0].nValue - 1000, CScript([OP_TRUE, OP_DROP] * 15 + [OP_TRUE])))
+        tx3.vout.append(CTxOut(tx2.vout[0].nValue - 1000, ANYONE_CAN_SPEND_SCRIPT))
         tx3.rehash()
-        test_transaction_acceptance(self.nodes[0].rpc, self.test_node, tx2, with_witness=True, accepted=True)
-
-        test_transaction_acceptance(self.nodes[0].rpc, self.test_node, tx3, with_witness=True, accepted=True)
+        test_transactions_acceptance(self.nodes[0].rpc, self.test_node, [tx2, tx3], with_witness=True, accepted=True)
 
         self.nodes[0].generate(1, self.signblockprivkeys)
         sync_blocks(self.nodes)
@@ -1811,14 +1886,21 @@ class SegWitTest(BitcoinTestFramework):
     @subtest
     def test_non_standard_witness(self):
         """Test detection of non-standard P2WSH witness"""
-        pad = chr(1).encode('latin-1')
+        pad = b'\x01'
+        # Padding shared by the P2WSH and P2SH-P2WSH witness stacks below
+        # (each stack is a fresh list built by concatenating onto these)
+        pad_x101 = [pad] * 101
+        pad81_x100 = [pad * 81] * 100
+        pad80_x100 = [pad * 80] * 100
 
         # Create scripts for tests
         scripts = []
         scripts.append(CScript([OP_DROP] * 100))
         scripts.append(CScript([OP_DROP] * 99))
-        scripts.append(CScript([pad * 59] * 59 + [OP_DROP] * 60))
-        scripts.append(CScript([pad * 59] * 59 + [OP_DROP] * 61))
+        # The last two scripts share their 59 pushes, so encode them once.
+        pushes = CScript([pad * 59] * 59)
+        scripts.append(CScript(b"".join([pushes, bytes([OP_DROP] * 60)])))
+        scripts.append(CScript(b"".join([pushes, bytes([OP_DROP] * 61)])))
 
         p2wsh_scripts = []
 
@@ -1843,38 +1925,38 @@ class SegWitTest(BitcoinTestFramework):
         # Creating transactions for tests
         p2wsh_txs = []
         p2sh_txs = []
+        # Every spend pays to the same P2WPKH output.
+        script_pkh_empty = CScript([OP_0, hash160(b"")])
         for i in range(len(scripts)):
             p2wsh_tx = CTransaction()
             p2wsh_tx.vin.append(CTxIn(COutPoint(txid, i * 2)))
-            p2wsh_tx.vout.append(CTxOut(outputvalue - 5000, CScript([OP_0, hash160(hex_str_to_bytes(""))])))
+            p2wsh_tx.vout.append(CTxOut(outputvalue - 5000, script_pkh_empty))
             p2wsh_tx.wit.vtxinwit.append(CTxInWitness())
             p2wsh_tx.rehash()
             p2wsh_txs.append(p2wsh_tx)
             p2sh_tx = CTransaction()
             p2sh_tx.vin.append(CTxIn(COutPoint(txid, i * 2 + 1), CScript([p2wsh_scripts[i]])))
-            p2sh_tx.vout.append(CTxOut(outputvalue - 5000, CScript([OP_0, hash160(hex_str_to_bytes(""))])))
+            p2sh_tx.vout.append(CTxOut(outputvalue - 5000, script_pkh_empty))
             p2sh_tx.wit.vtxinwit.append(CTxInWitness())
             p2sh_tx.rehash()
             p2sh_txs.append(p2sh_tx)
 
         # Testing native P2WSH
         # Witness stack size, excluding witnessScript, over 100 is non-standard
-        p2wsh_txs[0].wit.vtxinwit[0].scriptWitness.stack = [pad] * 101 + [scripts[0]]
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[0], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[0], with_witness=False, accepted=False, reason=b'scriptpubkey')
+        p2wsh_txs[0].wit.vtxinwit[0].scriptWitness.stack = pad_x101 + [scripts[0]]
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2wsh_txs[0], reason=b'scriptpubkey')
         # Non-standard nodes should accept
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2wsh_txs[0], with_witness=True, accepted=False)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2wsh_txs[0], with_witness=False, accepted=True)
 
         # Stack element size over 80 bytes is non-standard
-        p2wsh_txs[1].wit.vtxinwit[0].scriptWitness.stack = [pad * 81] * 100 + [scripts[1]]
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[1], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[1], with_witness=False, accepted=False, reason=b'scriptpubkey')
+        p2wsh_txs[1].wit.vtxinwit[0].scriptWitness.stack = pad81_x100 + [scripts[1]]
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2wsh_txs[1], reason=b'scriptpubkey')
         # Non-standard nodes should accept
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2wsh_txs[1], with_witness=False, accepted=True)
 
         # Standard nodes should accept if element size is not over 80 bytes
-        p2wsh_txs[1].wit.vtxinwit[0].scriptWitness.stack = [pad * 80] * 100 + [scripts[1]]
+        p2wsh_txs[1].wit.vtxinwit[0].scriptWitness.stack = pad80_x100 + [scripts[1]]
         test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[1], with_witness=False, accepted=False, reason=b'scriptpubkey')
 
         # witnessScript size at 3600 bytes is standard
@@ -1882,46 +1964,39 @@ class SegWitTest(BitcoinTestFramework):
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2wsh_txs[2], with_witness=True, accepted=False)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2wsh_txs[2], with_witness=False, accepted=True)
 
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[2], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[2], with_witness=False, accepted=False, reason=b'scriptpubkey')
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2wsh_txs[2], reason=b'scriptpubkey')
 
         # witnessScript size at 3601 bytes is non-standard
         p2wsh_txs[3].wit.vtxinwit[0].scriptWitness.stack = [pad, pad, pad, scripts[3]]
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[3], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2wsh_txs[3], with_witness=False, accepted=False, reason=b'scriptpubkey')
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2wsh_txs[3], reason=b'scriptpubkey')
         # Non-standard nodes should accept
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2wsh_txs[3], with_witness=True, accepted=False)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2wsh_txs[3], with_witness=False, accepted=True)
 
         # Repeating the same tests with P2SH-P2WSH
-        p2sh_txs[0].wit.vtxinwit[0].scriptWitness.stack = [pad] * 101 + [scripts[0]]
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[0], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[0], with_witness=False, accepted=False, reason=b'scriptpubkey')
+        p2sh_txs[0].wit.vtxinwit[0].scriptWitness.stack = pad_x101 + [scripts[0]]
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2sh_txs[0], reason=b'scriptpubkey')
 
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2sh_txs[0], with_witness=True, accepted=False)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2sh_txs[0], with_witness=False, accepted=True)
 
-        p2sh_txs[1].wit.vtxinwit[0].scriptWitness.stack = [pad * 81] * 100 + [scripts[1]]
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[1], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[1], with_witness=False, accepted=False, reason=b'scriptpubkey')
+        p2sh_txs[1].wit.vtxinwit[0].scriptWitness.stack = pad81_x100 + [scripts[1]]
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2sh_txs[1], reason=b'scriptpubkey')
 
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2sh_txs[1], with_witness=True, accepted=False)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2sh_txs[1], with_witness=False, accepted=True)
 
-        p2sh_txs[1].wit.vtxinwit[0].scriptWitness.stack = [pad * 80] * 100 + [scripts[1]]
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[1], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[1], with_witness=False, accepted=False)
+        p2sh_txs[1].wit.vtxinwit[0].scriptWitness.stack = pad80_x100 + [scripts[1]]
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2sh_txs[1])
 
         p2sh_txs[2].wit.vtxinwit[0].scriptWitness.stack = [pad, pad, scripts[2]]
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2sh_txs[2], with_witness=True, accepted=False)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2sh_txs[2], with_witness=False, accepted=True)
 
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[2], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[2], with_witness=False, accepted=False, reason=b'scriptpubkey')
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2sh_txs[2], reason=b'scriptpubkey')
 
         p2sh_txs[3].wit.vtxinwit[0].scriptWitness.stack = [pad, pad, pad, scripts[3]]
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[3], with_witness=True, accepted=False)
-        test_transaction_acceptance(self.nodes[1].rpc, self.std_node, p2sh_txs[3], with_witness=False, accepted=False, reason=b'scriptpubkey')
+        test_transaction_rejection(self.nodes[1].rpc, self.std_node, p2sh_txs[3], reason=b'scriptpubkey')
 
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2sh_txs[3], with_witness=True, accepted=False)
         test_transaction_acceptance(self.nodes[0].rpc, self.test_node, p2sh_txs[3], with_witness=False, accepted=True)
@@ -1929,8 +2004,8 @@ class SegWitTest(BitcoinTestFramework):
         self.nodes[0].generate(1, self.signblockprivkeys)  # Mine and clean up the mempool of non-standard node
         # Valid but non-standard transactions in a block should be accepted by standard node
         sync_blocks(self.nodes)
-        assert_equal(len(self.nodes[0].getrawmempool()), 0)
-        assert_equal(len(self.nodes[1].getrawmempool()), 0)
+        assert_equal(self.nodes[0].getmempoolinfo()['size'], 0)
+        assert_equal(self.nodes[1].getmempoolinfo()['size'], 0)
 
         self.utxo.pop(0)
         self.utxo.append(UTXO(p2wsh_txs[0].malfixsha256, 0, p2wsh_txs[0].vout[0].nValue))
@@ -1946,13 +2021,16 @@ class SegWitTest(BitcoinTestFramework):
 
         sync_blocks(self.nodes)
 
-        # Make sure this peer's blocks match those of node0.
-        height = self.nodes[2].getblockcount()
-        while height >= 0:
-            block_hash = self.nodes[2].getblockhash(height)
-            assert_equal(block_hash, self.nodes[0].getblockhash(height))
-            assert_equal(self.nodes[0].getblock(block_hash), self.nodes[2].getblock(block_hash))
-            height -= 1
+        # Make sure this peer's blocks match those of node0. Each node is
+        # asked for all hashes, then all blocks, in one batched round trip.
+        heights = range(self.nodes[2].getblockcount() + 1)
+        node0, node2 = self.nodes[0], self.nodes[2]
+        block_hashes = batch_results(node2, [node2.getblockhash.get_request(h) for h in heights])
+        assert_equal(block_hashes, batch_results(node0, [node0.getblockhash.get_request(h) for h in heights]))
+        # Raw blocks are enough to check that the nodes agree on the contents
+        # and are far cheaper to encode than the verbose JSON.
+        assert_equal(batch_results(node0, [node0.getblock.get_request(h, False) for h in block_hashes]),
+                     batch_results(node2, [node2.getblock.get_request(h, False) for h in block_hashes]))
 
     @subtest
     def test_witness_sigops(self):
@@ -1961,7 +2039,7 @@ class SegWitTest(BitcoinTestFramework):
         # Keep this under MAX_OPS_PER_SCRIPT (201)
         witness_program = CScript([OP_TRUE, OP_IF, OP_TRUE, OP_ELSE] + [OP_CHECKMULTISIG] * 5 + [OP_CHECKSIG] * 193 + [OP_ENDIF])
         witness_hash = sha256(witness_program)
-        script_pubkey = CScript([OP_0, witness_hash])
+        script_pubkey = get_p2wsh_script(witness_hash)
 
         sigops_per_script = 20 * 5 + 193 * 1
         # We'll produce 2 extra outputs, one with a program that would take us
@@ -1973,27 +2051,32 @@ class SegWitTest(BitcoinTestFramework):
         # We chose the number of checkmultisigs/checksigs to make this work:
         assert(extra_sigops_available < 100)  # steer clear of MAX_OPS_PER_SCRIPT
 
+        # The two scripts below differ only in their number of checksigs.
+        def checksig_program(count):
+            return CScript([OP_TRUE, OP_IF, OP_TRUE, OP_ELSE] + [OP_CHECKSIG] * count + [OP_ENDIF])
+
         # This script, when spent with the first
         # N(=MAX_SIGOP_COST//sigops_per_script) outputs of our transaction,
         # would push us just over the block sigop limit.
-        witness_program_toomany = CScript([OP_TRUE, OP_IF, OP_TRUE, OP_ELSE] + [OP_CHECKSIG] * (extra_sigops_available + 1) + [OP_ENDIF])
+        witness_program_toomany = checksig_program(extra_sigops_available + 1)
         witness_hash_toomany = sha256(witness_program_toomany)
-        script_pubkey_toomany = CScript([OP_0, witness_hash_toomany])
+        script_pubkey_toomany = get_p2wsh_script(witness_hash_toomany)
 
         # If we spend this script instead, we would exactly reach our sigop
         # limit (for witness sigops).
-        witness_program_justright = CScript([OP_TRUE, OP_IF, OP_TRUE, OP_ELSE] + [OP_CHECKSIG] * (extra_sigops_available) + [OP_ENDIF])
+        witness_program_justright = checksig_program(extra_sigops_available)
         witness_hash_justright = sha256(witness_program_justright)
-        script_pubkey_justright = CScript([OP_0, witness_hash_justright])
+        script_pubkey_justright = get_p2wsh_script(witness_hash_justright)
 
         # First split our available utxo into a bunch of outputs
         split_value = self.utxo[0].nValue // outputs
         tx = CTransaction()
         tx.vin.append(CTxIn(COutPoint(self.utxo[0].sha256, self.utxo[0].n), b""))
-        for i in range(outputs):
-            tx.vout.append(CTxOut(split_value, script_pubkey))
-        tx.vout[-2].scriptPubKey = script_pubkey_toomany
-        tx.vout[-1].scriptPubKey = script_pubkey_justright
+        # All but the last two outputs are identical and never modified,
+        # so they share one CTxOut.
+        tx.vout = [CTxOut(split_value, script_pubkey)] * (outputs - 2)
+        tx.vout.append(CTxOut(split_value, script_pubkey_toomany))
+        tx.vout.append(CTxOut(split_value, script_pubkey_justright))
         tx.rehash()
 
         block_1 = self.build_next_block()
@@ -2004,13 +2087,12 @@ class SegWitTest(BitcoinTestFramework):
         tx2 = CTransaction()
         # If we try to spend the first n-1 outputs from tx, that should be
         # too many sigops.
-        total_value = 0
-        for i in range(outputs - 1):
-            tx2.vin.append(CTxIn(COutPoint(tx.malfixsha256, i), b""))
-            tx2.wit.vtxinwit.append(CTxInWitness())
-            tx2.wit.vtxinwit[-1].scriptWitness.stack = [witness_program]
-            total_value += tx.vout[i].nValue
+        tx2.vin = [CTxIn(COutPoint(tx.malfixsha256, i), b"") for i in range(outputs - 1)]
+        tx2.wit.vtxinwit = [CTxInWitness() for i in range(outputs - 1)]
+        for wit in tx2.wit.vtxinwit[:-1]:
+            wit.scriptWitness.stack = [witness_program]
         tx2.wit.vtxinwit[-1].scriptWitness.stack = [witness_program_toomany]
+        total_value = sum(txout.nValue for txout in tx.vout[:outputs - 1])
         tx2.vout.append(CTxOut(total_value, CScript([OP_TRUE])))
         tx2.rehash()
 
@@ -27,7 +27,6 @@ from .messages import (
     ser_string,
     ser_uint256,
     sha256,
-    uint256_from_str,
 )
 from .script import (
     CScript,
@@ -50,8 +49,11 @@ import time, random
 # From BIP141
 WITNESS_COMMITMENT_HEADER = b"\xaa\x21\xa9\xed"
 
-def create_block(hashprev, coinbase, ntime=None):
-    """Create a block (with regtest difficulty)."""
+def create_block(hashprev, coinbase, ntime=None, txlist=None):
+    """Create a block (with regtest difficulty).
+
+    If txlist is passed in, those transactions are added after the coinbase
+    before the merkle roots are computed."""
     block = CBlock()
     if ntime is None:
         block.nTime = int(time.time() + 600)
@@ -59,8 +61,9 @@ def create_block(hashprev, coinbase, ntime=None):
         block.nTime = ntime
     block.hashPrevBlock = hashprev
     block.vtx.append(coinbase)
-    block.hashMerkleRoot = block.calc_merkle_root()
-    block.hashImMerkleRoot = block.calc_immutable_merkle_root()
+    if txlist:
+        block.vtx.extend(txlist)
+    block.hashMerkleRoot, block.hashImMerkleRoot = block.calc_merkle_roots()
     block.calc_sha256()
     return block
 
@@ -89,8 +92,10 @@ def createTestGenesisBlock(signblockpubkeys, signblockthreshold, signblockprivke
     return genesis
 
 def get_witness_script(witness_root, witness_nonce):
-    witness_commitment = uint256_from_str(hash256(ser_uint256(witness_root) + ser_uint256(witness_nonce)))
-    output_data = WITNESS_COMMITMENT_HEADER + ser_uint256(witness_commitment)
+    # The commitment digest goes into the script as is; round-tripping it
+    # through an integer would only reproduce the same 32 bytes.
+    witness_commitment = hash256(ser_uint256(witness_root) + ser_uint256(witness_nonce))
+    output_data = WITNESS_COMMITMENT_HEADER + witness_commitment
     return CScript([OP_RETURN, output_data])
 
 def add_witness_commitment(block, nonce=0):
@@ -109,8 +114,7 @@ def add_witness_commitment(block, nonce=0):
     # witness commitment is the last OP_RETURN output in coinbase
     block.vtx[0].vout.append(CTxOut(0, get_witness_script(witness_root, witness_nonce)))
     block.vtx[0].rehash()
-    block.hashMerkleRoot = block.calc_merkle_root()
-    block.hashImMerkleRoot = block.calc_immutable_merkle_root()
+    block.hashMerkleRoot, block.hashImMerkleRoot = block.calc_merkle_roots()
     block.rehash()
 
 def serialize_script_num(value):
@@ -171,14 +175,31 @@ def create_transaction(node, txid, to_address, *, amount):
     tx.deserialize(BytesIO(hex_str_to_bytes(raw_tx)))
     return tx
 
+def create_transaction_to_script(node, txid, script_pub_key, *, amount):
+    """ Return signed transaction spending the first output of the
+        input txid to script_pub_key. Unlike create_transaction, the
+        unsigned transaction is built locally, so only the signing
+        goes to the node's wallet.
+    """
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(int(txid, 16), 0), b"", 0xffffffff))
+    tx.vout.append(CTxOut(int(round(amount * COIN)), script_pub_key))
+    return FromHex(CTransaction(), sign_raw_transaction(node, tx.serialize().hex()))
+
 def create_raw_transaction(node, txid, to_address, *, amount):
     """ Return raw signed transaction spending the first output of the
         input txid. Note that the node must be able to sign for the
         output that is being spent, and the node must not be running
         multiple wallets.
     """
-    scheme = random.choice(["ECDSA", "SCHNORR"])
     rawtx = node.createrawtransaction(inputs=[{"txid": txid, "vout": 0}], outputs={to_address: amount})
+    return sign_raw_transaction(node, rawtx)
+
+def sign_raw_transaction(node, rawtx):
+    """ Return rawtx signed by the node's wallet with a randomly
+        chosen signature scheme.
+    """
+    scheme = random.choice(["ECDSA", "SCHNORR"])
     signresult = node.signrawtransactionwithwallet(rawtx, [], "ALL", scheme)
     assert_equal(signresult["complete"], True)
     return signresult['hex']
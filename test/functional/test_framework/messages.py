@@ -54,18 +54,25 @@ MSG_TYPE_MASK = 0xffffffff >> 2
 
 # Serialization/deserialization tools
 def sha256(s):
-    return hashlib.new('sha256', s).digest()
+    # hashlib.sha256 is always available and skips hashlib.new's name lookup;
+    # it runs on OpenSSL's implementation (SHA-NI where the CPU has it).
+    return hashlib.sha256(s).digest()
 
 def ripemd160(s):
     return hashlib.new('ripemd160', s).digest()
 
 def hash256(s):
-    return sha256(sha256(s))
+    # Called for every txid and merkle node, so go straight to hashlib's
+    # C implementation instead of through the sha256() helper twice.
+    return hashlib.sha256(hashlib.sha256(s).digest()).digest()
+
+# Single-byte encodings, which cover almost every length we serialize
+_COMPACT_SIZE_SMALL = [bytes([i]) for i in range(253)]
 
 def ser_compact_size(l):
     r = b""
-    if l < 253:
-        r = struct.pack("B", l)
+    if 0 <= l < 253:
+        return _COMPACT_SIZE_SMALL[l]
     elif l < 0x10000:
         r = struct.pack("<BH", 253, l)
     elif l < 0x100000000:
@@ -74,6 +81,16 @@ def ser_compact_size(l):
         r = struct.pack("<BQ", 255, l)
     return r
 
+# Length of ser_compact_size(n), without building it
+def ser_compact_size_len(n):
+    if n < 253:
+        return 1
+    elif n < 0x10000:
+        return 3
+    elif n < 0x100000000:
+        return 5
+    return 9
+
 def deser_compact_size(f):
     nit = struct.unpack("<B", f.read(1))[0]
     if nit == 253:
@@ -92,27 +109,16 @@ def ser_string(s):
     return ser_compact_size(len(s)) + s
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return int.from_bytes(f.read(32), 'little')
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    # Masking keeps the old behaviour of serializing only the low 256 bits.
+    return (u & ((1 << 256) - 1)).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], 'little')
 
 
 def uint256_from_compact(c):
@@ -135,11 +141,9 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None, **kwargs):
-    r = ser_compact_size(len(l))
-    ckwargs = copy.deepcopy(kwargs)
-    for i in l:
-        r += i.serialize(**(copy.deepcopy(ckwargs)))
-    return r
+    # Unpacking kwargs hands each entry a fresh dict, so the entries cannot
+    # see each other's modifications and no deep copy is needed.
+    return ser_compact_size(len(l)) + b"".join(i.serialize(**kwargs) for i in l)
 
 
 def deser_uint256_vector(f):
@@ -168,10 +172,10 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
-    for sv in l:
-        r += ser_string(sv)
-    return r
+    return ser_compact_size(len(l)) + b"".join([ser_string(sv) for sv in l])
+
+def ser_string_vector_len(vec):
+    return ser_compact_size_len(len(vec)) + sum(ser_compact_size_len(len(sv)) + len(sv) for sv in vec)
 
 
 # Deserialize from a hex string representation (eg from RPC)
@@ -274,10 +278,7 @@ class COutPoint():
         self.n = struct.unpack("<I", f.read(4))[0]
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        return ser_uint256(self.hash) + struct.pack("<I", self.n)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
@@ -299,12 +300,13 @@ class CTxIn():
         self.nSequence = struct.unpack("<I", f.read(4))[0]
 
     def serialize(self, **kwargs):
-        r = b""
-        r += self.prevout.serialize()
-        if(kwargs.get('with_scriptsig') == True or kwargs.get('with_scriptsig') == None):
-            r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        with_scriptsig = kwargs.get('with_scriptsig')
+        if(with_scriptsig == True or with_scriptsig == None):
+            return b"".join([self.prevout.serialize(), ser_string(self.scriptSig), struct.pack("<I", self.nSequence)])
+        return self.prevout.serialize() + struct.pack("<I", self.nSequence)
+
+    def serialized_size(self):
+        return 36 + ser_compact_size_len(len(self.scriptSig)) + len(self.scriptSig) + 4
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -322,10 +324,10 @@ class CTxOut():
         self.scriptPubKey = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        return struct.pack("<q", self.nValue) + ser_string(self.scriptPubKey)
+
+    def serialized_size(self):
+        return 8 + ser_compact_size_len(len(self.scriptPubKey)) + len(self.scriptPubKey)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -374,13 +376,11 @@ class CTxWitness():
             self.vtxinwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
-        for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+        # Join the inputs' serializations once instead of growing a string.
+        return b"".join([x.serialize() for x in self.vtxinwit])
 
     def __repr__(self):
         return "CTxWitness(%s)" % \
@@ -437,35 +437,50 @@ class CTransaction():
         self.hash = None
 
     def serialize_without_witness(self, **kwargs):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin, **kwargs)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        return b"".join([struct.pack("<i", self.nVersion),
+                         ser_vector(self.vin, **kwargs),
+                         ser_vector(self.vout),
+                         struct.pack("<I", self.nLockTime)])
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self, **kwargs):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        # Collect the parts and join them once; appending to a bytes
+        # object copies everything serialized so far, which adds up for
+        # transactions carrying large witnesses.
+        r = [struct.pack("<i", self.nVersion)]
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin, **kwargs)
-        r += ser_vector(self.vout)
+            r.append(ser_vector(dummy))
+            r.append(struct.pack("<B", flags))
+        r.append(ser_vector(self.vin, **kwargs))
+        r.append(ser_vector(self.vout))
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            r.append(self.wit.serialize())
+        r.append(struct.pack("<I", self.nLockTime))
+        return b"".join(r)
+
+    # Length of serialize(with_witness=with_witness), computed from the
+    # field sizes so that no serialization has to be built.
+    def serialized_size(self, with_witness=False):
+        size = 4 + ser_compact_size_len(len(self.vin)) + ser_compact_size_len(len(self.vout)) + 4
+        size += sum(i.serialized_size() for i in self.vin)
+        size += sum(o.serialized_size() for o in self.vout)
+        if with_witness and not self.wit.is_null():
+            # marker and flag, then one witness per input (missing ones
+            # are serialized as empty stacks)
+            size += 2
+            vtxinwit = self.wit.vtxinwit[:len(self.vin)]
+            size += sum(ser_string_vector_len(w.scriptWitness.stack) for w in vtxinwit)
+            size += len(self.vin) - len(vtxinwit)
+        return size
 
     # Regular serialization is without witness -- must explicitly
     # call serialize_with_witness to include witness flag.
@@ -487,20 +502,41 @@ class CTransaction():
     def calc_sha256(self, with_witness=False):
         if with_witness:
             # Don't cache the result, just return it
-            witHash = uint256_from_str(hash256(self.serialize()))
+            witHash = uint256_from_str(self.calc_wtxid_bytes())
             return witHash
 
         if self.sha256 is None:
-            txbytes = self.serialize(with_witness=False)
-
-            self.sha256 = uint256_from_str(hash256(txbytes))
-            self.hash = encode(hash256(txbytes)[::-1], 'hex_codec').decode('ascii')
-
-            txbytes2 = self.serialize(with_witness=False, with_scriptsig=False)
+            # The txid and malfix preimages differ only in the inputs'
+            # scriptSigs, so serialize everything else (including each
+            # input's outpoint and sequence) once and share it.
+            head = struct.pack("<i", self.nVersion) + ser_compact_size(len(self.vin))
+            tail = ser_vector(self.vout) + struct.pack("<I", self.nLockTime)
+            txparts = [head]
+            malfixparts = [head]
+            for i in self.vin:
+                prevout = i.prevout.serialize()
+                sequence = struct.pack("<I", i.nSequence)
+                txparts += [prevout, ser_string(i.scriptSig), sequence]
+                malfixparts += [prevout, sequence]
+            txparts.append(tail)
+            malfixparts.append(tail)
+
+            txhash = hash256(b"".join(txparts))
+
+            self.sha256 = uint256_from_str(txhash)
+            self.hash = encode(txhash[::-1], 'hex_codec').decode('ascii')
+
+            malfixhash = hash256(b"".join(malfixparts))
+
+            self.malfixsha256 = uint256_from_str(malfixhash)
+            self.hashMalFix = encode(malfixhash[::-1], 'hex_codec').decode('ascii')
+
+    # Raw wtxid digest, as calc_sha256(True) and the witness merkle root use
+    # it. serialize() leaves out the witness data, so here the wtxid bytes
+    # equal the txid bytes (the digest behind self.sha256).
+    def calc_wtxid_bytes(self):
+        return hash256(self.serialize())
 
-            self.malfixsha256 = uint256_from_str(hash256(txbytes2))
-            self.hashMalFix = encode(hash256(txbytes2)[::-1], 'hex_codec').decode('ascii')
-            
     def is_valid(self):
         self.calc_sha256()
         for tout in self.vout:
@@ -557,26 +593,29 @@ class CBlockHeader():
         r += ser_string_vector(self.proof)
         return r
 
+    def _unsigned_header_ctx(self):
+        # sha256 state over every header field except the proof. Both the
+        # signature hash and the block hash start from it, so solve() can
+        # feed these fields once and copy() the state for each.
+        ctx = hashlib.sha256(struct.pack("<i", self.nVersion))
+        ctx.update(ser_uint256(self.hashPrevBlock))
+        ctx.update(ser_uint256(self.hashMerkleRoot))
+        ctx.update(ser_uint256(self.hashImMerkleRoot))
+        ctx.update(struct.pack("<I", self.nTime))
+        return ctx
+
     def getsighash(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += ser_uint256(self.hashImMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        return hash256(r)
+        return hashlib.sha256(self._unsigned_header_ctx().digest()).digest()
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += ser_uint256(self.hashImMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += ser_string_vector(self.proof)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
+            ctx = self._unsigned_header_ctx()
+            ctx.update(ser_string_vector(self.proof))
+            self._set_hash(hashlib.sha256(ctx.digest()).digest())
+
+    def _set_hash(self, h):
+        self.sha256 = uint256_from_str(h)
+        self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
 
     def rehash(self):
         self.sha256 = None
@@ -588,6 +627,20 @@ class CBlockHeader():
             % (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot, self.hashImMerkleRoot, time.ctime(self.nTime), len(self.proof), [bytes_to_hex_str(sig) for sig in self.proof])
 
 
+# Block signing keys, parsed once per hex private key and reused by every
+# CBlock.solve() instead of being rebuilt for each block.
+_signblock_keys = {}
+
+def get_signblock_key(privkey):
+    key = _signblock_keys.get(privkey)
+    if key is None:
+        key = CECKey()
+        key.set_secretbytes(hex_str_to_bytes(privkey))
+        key.set_compressed(True)
+        _signblock_keys[privkey] = key
+    return key
+
+
 class CBlock(CBlockHeader):
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
@@ -603,30 +656,56 @@ class CBlock(CBlockHeader):
         r += ser_vector(self.vtx, **kwargs)
         return r
 
+    # Length of serialize(with_witness=with_witness), without building it
+    def serialized_size(self, with_witness=False):
+        return (4 + 32 * 3 + 4 + ser_string_vector_len(self.proof) + ser_compact_size_len(len(self.vtx))
+                + sum(tx.serialized_size(with_witness) for tx in self.vtx))
+
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
     def get_merkle_root(cls, hashes):
-        while len(hashes) > 1:
-            newhashes = []
-            for i in range(0, len(hashes), 2):
-                i2 = min(i+1, len(hashes)-1)
-                newhashes.append(hash256(hashes[i] + hashes[i2]))
-            hashes = newhashes
-        return uint256_from_str(hashes[0])
+        return cls.get_merkle_root_from_buffer(b"".join(hashes))
+
+    # Calculate the merkle root given the transaction hashes packed
+    # back to back in one buffer. Every level stays a single buffer, so
+    # pairs are hashed from 64-byte slices without per-hash objects.
+    @staticmethod
+    def get_merkle_root_from_buffer(level):
+        sha = hashlib.sha256
+        while len(level) > 32:
+            n = len(level)
+            view = memoryview(level)
+            # Double-SHA256 every 64-byte node of the level in one pass,
+            # with hashlib bound locally to keep per-node overhead down.
+            nodes = [sha(sha(view[i:i+64]).digest()).digest() for i in range(0, n - 63, 64)]
+            if n % 64:
+                # An odd hash out is paired with itself. Hash just that pair
+                # rather than copying the whole level to append it.
+                nodes.append(sha(sha(level[-32:] * 2).digest()).digest())
+            level = b"".join(nodes)
+        return uint256_from_str(level)
 
     def calc_merkle_root(self):
-        hashes = []
         for tx in self.vtx:
             tx.calc_sha256()
-            hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        return self.get_merkle_root_from_buffer(b"".join([ser_uint256(tx.sha256) for tx in self.vtx]))
 
     def calc_immutable_merkle_root(self):
+        for tx in self.vtx:
+            tx.calc_sha256()
+        return self.get_merkle_root_from_buffer(b"".join([ser_uint256(tx.malfixsha256) for tx in self.vtx]))
+
+    # Calculate both the merkle root and the immutable merkle root while
+    # walking (and hashing) the transactions only once.
+    def calc_merkle_roots(self):
         hashes = []
+        malfix_hashes = []
         for tx in self.vtx:
             tx.calc_sha256()
-            hashes.append(ser_uint256(tx.malfixsha256))
-        return self.get_merkle_root(hashes)
+            hashes.append(ser_uint256(tx.sha256))
+            malfix_hashes.append(ser_uint256(tx.malfixsha256))
+        return (self.get_merkle_root_from_buffer(b"".join(hashes)),
+                self.get_merkle_root_from_buffer(b"".join(malfix_hashes)))
 
     def calc_witness_merkle_root(self):
         # For witness root purposes, the hash of the
@@ -634,8 +713,9 @@ class CBlock(CBlockHeader):
         hashes = [ser_uint256(0)]
 
         for tx in self.vtx[1:]:
-            # Calculate the hashes with witness data
-            hashes.append(ser_uint256(tx.calc_sha256(True)))
+            # Calculate the hashes used for the witness root (the
+            # serialization they cover does not include witness data)
+            hashes.append(tx.calc_wtxid_bytes())
 
         return self.get_merkle_root(hashes)
 
@@ -644,23 +724,21 @@ class CBlock(CBlockHeader):
         for tx in self.vtx:
             if not tx.is_valid():
                 return False
-        if self.calc_merkle_root() != self.hashMerkleRoot:
-            return False
-        if self.calc_immutable_merkle_root() != self.hashImMerkleRoot:
+        if self.calc_merkle_roots() != (self.hashMerkleRoot, self.hashImMerkleRoot):
             return False
         return True
 
     def solve(self, signblockprivkeys):
         # create signed blocks.
-        sighash = self.getsighash()
+        ctx = self._unsigned_header_ctx()
+        sighash = hashlib.sha256(ctx.copy().digest()).digest()
         self.proof.clear()
         for privkey in signblockprivkeys:
-            signKey = CECKey()
-            signKey.set_secretbytes(hex_str_to_bytes(privkey))
-            signKey.set_compressed(True)
-            sig = signKey.sign(sighash)
+            sig = get_signblock_key(privkey).sign(sighash)
             self.proof.append(sig)
-        self.rehash()
+        # The block hash continues from the state the sighash was taken from.
+        ctx.update(ser_string_vector(self.proof))
+        self._set_hash(hashlib.sha256(ctx.digest()).digest())
 
     def __repr__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x hashImMerkleRoot=%064x nTime=%s proof[%d]=%s vtx=%s)" \
@@ -649,29 +649,38 @@ def SignatureHash(script, txTo, inIdx, hashtype):
 # Performance optimization probably not necessary for python tests, however.
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
 # for version 0 witnesses.
-def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
+# cache may be a dict shared by calls signing inputs of the same txTo. The
+# hashes of all prevouts, sequences and outputs don't depend on the input
+# being signed, so they are computed once and reused from it. Each entry
+# only depends on some of txTo's fields: 'prevouts' on the outpoints in
+# txTo.vin, 'sequence' on the nSequence values in txTo.vin and 'outputs' on
+# txTo.vout. A cache stays valid across changes to txTo as long as the
+# fields behind the entries it holds are unchanged.
+def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount, cache=None):
+    if cache is None:
+        cache = {}
 
     hashPrevouts = 0
     hashSequence = 0
     hashOutputs = 0
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
+        if 'prevouts' not in cache:
+            serialize_prevouts = b"".join([i.prevout.serialize() for i in txTo.vin])
+            cache['prevouts'] = uint256_from_str(hash256(serialize_prevouts))
+        hashPrevouts = cache['prevouts']
 
     if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
+        if 'sequence' not in cache:
+            serialize_sequence = b"".join([struct.pack("<I", i.nSequence) for i in txTo.vin])
+            cache['sequence'] = uint256_from_str(hash256(serialize_sequence))
+        hashSequence = cache['sequence']
 
     if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+        if 'outputs' not in cache:
+            serialize_outputs = b"".join([o.serialize() for o in txTo.vout])
+            cache['outputs'] = uint256_from_str(hash256(serialize_outputs))
+        hashOutputs = cache['outputs']
     elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
         serialize_outputs = txTo.vout[inIdx].serialize()
         hashOutputs = uint256_from_str(hash256(serialize_outputs))
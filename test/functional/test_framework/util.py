@@ -6,7 +6,6 @@
 """Helpful routines for regression testing."""
 
 from base64 import b64encode
-from binascii import hexlify, unhexlify
 from decimal import Decimal, ROUND_DOWN
 import hashlib
 import inspect
@@ -184,7 +183,7 @@ def count_bytes(hex_string):
     return len(bytearray.fromhex(hex_string))
 
 def bytes_to_hex_str(byte_str):
-    return hexlify(byte_str).decode('ascii')
+    return byte_str.hex()
 
 def hash256(byte_str):
     sha256 = hashlib.sha256()
@@ -194,7 +193,7 @@ def hash256(byte_str):
     return sha256d.digest()[::-1]
 
 def hex_str_to_bytes(hex_str):
-    return unhexlify(hex_str.encode('ascii'))
+    return bytes.fromhex(hex_str)
 
 def str_to_b64str(string):
     return b64encode(string.encode('utf-8')).decode('ascii')
@@ -349,6 +348,21 @@ def get_bip9_status(node, key):
     info = node.getblockchaininfo()
     return info['bip9_softforks'][key]
 
+def batch_results(node, requests):
+    """Send requests to node in one JSON-RPC batch and return their results.
+
+    Raises JSONRPCException for the first request that failed, like a
+    direct call would. TestNodeCLI.batch leaves out 'error' on success and
+    stores the exception itself on failure, so both shapes are handled."""
+    results = node.batch(requests)
+    for r in results:
+        error = r.get('error')
+        if isinstance(error, JSONRPCException):
+            raise error
+        if error is not None:
+            raise JSONRPCException(error)
+    return [r['result'] for r in results]
+
 def set_node_times(nodes, t):
     for node in nodes:
         node.setmocktime(t)